@@ -7,118 +7,252 @@
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
 import argparse
-import datetime
+import codecs
+import collections
+import concurrent.futures
 import gzip
-import io
-import json
 import os
 import pathlib
+import queue
 import random
+import re
+import shutil
 import socket
 import subprocess
 import sys
 import tarfile
 import tempfile
+import threading
 import time
-from typing import Any, Dict, IO, Optional, Tuple
+from typing import Any, IO, Iterator, List, Optional, Tuple
 import urllib.request
 
+import orjson
+
+
+
+prefetchCount = 2
+
+# control characters that don't occur in LaTeX files (apart from tab, line feed, form feed, and
+# carriage return), used to detect binary files
+binaryCharacterRegex = re.compile(r"[\x00-\x08\x0b\x0e-\x1f]")
+# deletes all ASCII characters when passed to str.translate
+asciiDeletionTable = dict.fromkeys(range(128))
+binarySniffingSampleSize = 8192
+maxNonAsciiRatio = 0.4
+jsonTemplatePlaceholder = "$jsonTemplatePlaceholder$"
+
+
+
+def compileJsonTemplate(template: Any) -> List[bytes]:
+  # serialize the constant parts once; the placeholders are filled in by fillJsonTemplate
+  return orjson.dumps(template).split(orjson.dumps(jsonTemplatePlaceholder))
+
+
+
+def fillJsonTemplate(compiledTemplate: List[bytes], *values: Any) -> bytes:
+  if len(values) != len(compiledTemplate) - 1:
+    raise RuntimeError("Expected {} values for JSON template, got {}.".format(
+        len(compiledTemplate) - 1, len(values)))
+
+  parts = [compiledTemplate[0]]
+  for value, part in zip(values, compiledTemplate[1:]): parts += [orjson.dumps(value), part]
+  return b"".join(parts)
+
+
+
+def getLogPrefix(name: Optional[str]) -> str:
+  return "" if name is None else "[{}] ".format(name)
+
 
 
 class LSPClient(object):
-  def __init__(self, conn: socket.socket, stdout: IO[bytes], stderr: IO[bytes]) -> None:
+  receiveChunkSize = 65536
+  contentLengthRegex = re.compile(rb"Content-Length: *([0-9]+)")
+
+  initializeTemplate = compileJsonTemplate({"jsonrpc" : "2.0", "id" : jsonTemplatePlaceholder,
+      "method" : "initialize", "params" : {"processId" : jsonTemplatePlaceholder,
+        "rootUri" : None, "capabilities" : {}}})
+  # send_encoded_request fills the first placeholder with the request ID
+  assert initializeTemplate[0].endswith(b'"id":')
+  didOpenTemplate = compileJsonTemplate({"jsonrpc" : "2.0", "method" : "textDocument/didOpen",
+      "params" : {"textDocument" : {"uri" : jsonTemplatePlaceholder, "languageId" : "latex",
+        "version" : jsonTemplatePlaceholder, "text" : jsonTemplatePlaceholder}}})
+  didChangeTemplate = compileJsonTemplate({"jsonrpc" : "2.0", "method" : "textDocument/didChange",
+      "params" : {"textDocument" : {"uri" : jsonTemplatePlaceholder,
+        "version" : jsonTemplatePlaceholder},
+        "contentChanges" : [{"text" : jsonTemplatePlaceholder}]}})
+
+  def __init__(self, conn: socket.socket, stdout: IO[bytes], stderr: IO[bytes],
+        name: Optional[str] = None) -> None:
     self.conn = conn
+    self.logPrefix = getLogPrefix(name)
     self.stdout = stdout
     self.stderr = stderr
     self.stdoutPosition = 0
     self.stderrPosition = 0
+    self.stdoutDecoder = codecs.getincrementaldecoder("utf-8")()
+    self.stderrDecoder = codecs.getincrementaldecoder("utf-8")()
     self.requestCounter = 0
     self.documentCounter = 0
+    self.documentUri = "foo://document"
+    self.receiveBuffer = bytearray()
+    self.missingBodySize = 0
 
   @staticmethod
-  def wrap_message(body: str) -> bytes:
-    encodedBody = body.encode()
-    header = "Content-Length: {}\r\n".format(len(encodedBody)).encode()
-    return header + b"\r\n" + encodedBody
-
-  def read_response(self) -> Any:
-    header = b""
-    while not header.endswith(b"\r\n\r\n"): header += self.conn.recv(1)
-    headers: Dict[str, str] = dict([(x.split(": ")[0], x.split(": ")[1])
-        for x in header.decode()[:-4].split("\r\n")])
-    lengthBody = int(headers["Content-Length"])
-
-    body = b""
-    while len(body) < lengthBody: body += self.conn.recv(lengthBody - len(body))
-    response = json.loads(body)
+  def wrap_message(body: bytes) -> Tuple[bytes, bytes]:
+    header = "Content-Length: {}\r\n\r\n".format(len(body)).encode()
+    return header, body
 
-    return response
+  def send_message(self, body: bytes) -> None:
+    header, body = LSPClient.wrap_message(body)
 
-  def listen_for_response(self, requestId: int) -> Any:
-    response = {"id" : None}
+    if not hasattr(self.conn, "sendmsg"):
+      self.conn.sendall(header + body)
+      return
+
+    # send header and body without joining them first; sendmsg might only send a part
+    buffers = [memoryview(header), memoryview(body)]
+
+    while len(buffers) > 0:
+      numberOfSentBytes = self.conn.sendmsg(buffers)
+
+      while (len(buffers) > 0) and (numberOfSentBytes >= len(buffers[0])):
+        numberOfSentBytes -= len(buffers[0])
+        buffers.pop(0)
+
+      if numberOfSentBytes > 0: buffers[0] = buffers[0][numberOfSentBytes:]
+
+  def receive(self) -> None:
+    # if the body of a message is incomplete, request all of its missing bytes at once
+    chunk = self.conn.recv(max(LSPClient.receiveChunkSize, self.missingBodySize))
+    if len(chunk) == 0: raise RuntimeError("Language server closed the connection.")
+    self.receiveBuffer += chunk
+
+  def parse_buffered_response(self) -> Optional[Any]:
+    # keep bytes beyond the current message in the buffer, as the language server might have
+    # already sent further messages
+    headerEnd = self.receiveBuffer.find(b"\r\n\r\n")
+    if headerEnd == -1: return None
+
+    match = LSPClient.contentLengthRegex.search(self.receiveBuffer, 0, headerEnd)
+    if match is None: raise RuntimeError("Received message without Content-Length header.")
+    bodyStart = headerEnd + 4
+    bodyEnd = bodyStart + int(match.group(1))
+    self.missingBodySize = max(bodyEnd - len(self.receiveBuffer), 0)
+    if self.missingBodySize > 0: return None
 
-    while response["id"] != requestId:
-      response = self.read_response()
-      if "method" in response: self.process_notification(response)
-      elif response["id"] != requestId: self.process_response(response)
+    # parse the body in place instead of copying it out of the buffer first
+    with memoryview(self.receiveBuffer)[bodyStart:bodyEnd] as body:
+      response = orjson.loads(body)
+
+    del self.receiveBuffer[:bodyEnd]
 
     return response
 
-  def listen_for_notification(self, uri: Optional[str] = None) -> Any:
+  def read_buffered_responses(self) -> Iterator[Any]:
     while True:
-      response = self.read_response()
+      response = self.parse_buffered_response()
+      if response is None: return
+      yield response
 
-      if (uri is None) or (("uri" in response["params"]) and (response["params"]["uri"] == uri)):
-        break
+  def listen_for_response(self, requestId: int) -> Any:
+    # handle all messages that have already been received before waiting for new data
+    while True:
+      for response in self.read_buffered_responses():
+        if "method" in response: self.process_notification(response)
+        elif response["id"] == requestId: return response
+        else: self.process_response(response)
 
-    return response
+      self.receive()
+
+  def listen_for_notification(self, uri: Optional[str] = None,
+        version: Optional[int] = None) -> Any:
+    while True:
+      for response in self.read_buffered_responses():
+        params = response["params"]
+        if (uri is not None) and (("uri" not in params) or (params["uri"] != uri)): continue
+        # skip late notifications for previous versions of the document
+        if (version is not None) and ("version" in params) and (params["version"] != version):
+          continue
+        return response
+
+      self.receive()
 
   def process_response(self, response: Any) -> None:
-    print("Received response: {}".format(response))
+    self.log("Received response: {}".format(response))
 
   def process_notification(self, notification: Any) -> None:
-    print("Received notification: {}".format(notification))
+    self.log("Received notification: {}".format(notification))
+
+  def log(self, message: str = "") -> None:
+    # print with a single write, as other language servers might log from other threads
+    print(self.logPrefix + message + "\n", end="")
 
   @staticmethod
-  def indent_output(output: str) -> str:
+  def indent_output(output: str, prefix: str = "") -> str:
     if len(output) == 0: return ""
-    indentation = 4 * " "
+    indentation = prefix + 4 * " "
     indentedOutput = indentation + output.replace("\n", "\n" + indentation)
     if output.endswith("\n"): indentedOutput = indentedOutput[:-len(indentation)]
     return indentedOutput
 
+  @staticmethod
+  def read_new_output(file: IO[bytes], position: int,
+        decoder: codecs.IncrementalDecoder) -> Tuple[str, int]:
+    # only read what has been appended since the last call; the decoder keeps incomplete
+    # multi-byte sequences at the end for the next call
+    size = os.fstat(file.fileno()).st_size
+    if size <= position: return "", position
+
+    if hasattr(os, "pread"):
+      output = os.pread(file.fileno(), size - position, position)
+    else:
+      file.seek(position)
+      output = file.read(size - position)
+
+    return decoder.decode(output), size
+
   def print_output(self) -> Tuple[str, str]:
-    self.stdout.seek(self.stdoutPosition)
-    stdoutOutput = self.stdout.read().decode()
-    print(LSPClient.indent_output(stdoutOutput), end="")
-    self.stdout.seek(0, io.SEEK_END)
-    self.stdoutPosition = self.stdout.tell()
-
-    self.stderr.seek(self.stderrPosition)
-    stderrOutput = self.stderr.read().decode()
-    print(LSPClient.indent_output(stderrOutput), file=sys.stderr, end="")
-    self.stderr.seek(0, io.SEEK_END)
-    self.stderrPosition = self.stderr.tell()
+    stdoutOutput, self.stdoutPosition = LSPClient.read_new_output(
+        self.stdout, self.stdoutPosition, self.stdoutDecoder)
+    print(LSPClient.indent_output(stdoutOutput, self.logPrefix), end="")
+
+    stderrOutput, self.stderrPosition = LSPClient.read_new_output(
+        self.stderr, self.stderrPosition, self.stderrDecoder)
+    print(LSPClient.indent_output(stderrOutput, self.logPrefix), file=sys.stderr, end="")
 
     return stdoutOutput, stderrOutput
 
   def send_request(self, method: str, params: Any, verbose: bool = True,
         failOnStderrOutput: bool = True) -> Any:
-    self.print_output()
     self.requestCounter += 1
     requestId = self.requestCounter
+    body = orjson.dumps({"jsonrpc" : "2.0", "id" : requestId, "method" : method, "params" : params})
+    return self.send_request_body(requestId, body, verbose, failOnStderrOutput)
+
+  def send_encoded_request(self, template: List[bytes], *values: Any, verbose: bool = True,
+        failOnStderrOutput: bool = True) -> Any:
+    # the first placeholder of the template is filled with the request ID, the remaining
+    # placeholders with values
+    self.requestCounter += 1
+    requestId = self.requestCounter
+    body = fillJsonTemplate(template, requestId, *values)
+    return self.send_request_body(requestId, body, verbose, failOnStderrOutput)
+
+  def send_request_body(self, requestId: int, body: bytes, verbose: bool,
+        failOnStderrOutput: bool) -> Any:
+    self.print_output()
 
-    body = json.dumps({"jsonrpc" : "2.0", "id" : requestId, "method" : method, "params" : params})
-    lspRequest = LSPClient.wrap_message(body)
-    if verbose: print("Sending request: {}".format(body))
-    self.conn.send(lspRequest)
+    if verbose: self.log("Sending request: {}".format(body.decode()))
+    self.send_message(body)
 
-    startTime = datetime.datetime.now()
+    startTime = time.perf_counter()
     response = self.listen_for_response(requestId)
-    duration = (datetime.datetime.now() - startTime).total_seconds()
+    duration = time.perf_counter() - startTime
     stdoutOutput, stderrOutput = self.print_output()
 
-    if verbose: print("Received response after {:.1f}s: {}".format(duration, response))
+    if verbose: self.log("Received response after {:.1f}s: {}".format(duration, response))
 
     if failOnStderrOutput and (len(stderrOutput) > 0):
       raise RuntimeError("Detected output on stderr.")
@@ -126,36 +260,40 @@ class LSPClient(object):
     return response
 
   def send_notification(self, method: str, params: Any, verbose: bool = True) -> None:
+    self.send_encoded_notification(
+        orjson.dumps({"jsonrpc" : "2.0", "method" : method, "params" : params}), verbose=verbose)
+
+  def send_encoded_notification(self, body: bytes, verbose: bool = True) -> None:
     self.print_output()
 
-    body = json.dumps({"jsonrpc" : "2.0", "method" : method, "params" : params})
-    lspNotification = LSPClient.wrap_message(body)
-    if verbose: print("Sending notification: {}".format(body))
-    self.conn.send(lspNotification)
+    if verbose: self.log("Sending notification: {}".format(body.decode()))
+    self.send_message(body)
 
   def validate_document(self, text: str, verbose: bool = False, failOnStderrOutput: bool = True,
         path: Optional[str] = None) -> None:
     self.print_output()
     self.documentCounter += 1
-    uri = "foo://{}".format(self.documentCounter)
+    uri = self.documentUri
 
     if not verbose:
-      print("Checking {} with {} characters...".format(
+      self.log("Checking {} with {} characters...".format(
           (path if path is not None else "document"), len(text)))
 
-    self.send_notification("textDocument/didOpen", {
-          "textDocument" : {"uri" : uri, "languageId" : "latex", "version" : 1, "text" : text},
-        }, verbose=verbose)
+    # reuse the same document for all checks to keep the caches of the language server warm
+    template = (LSPClient.didOpenTemplate if self.documentCounter == 1 else
+        LSPClient.didChangeTemplate)
+    self.send_encoded_notification(fillJsonTemplate(template, uri, self.documentCounter, text),
+        verbose=verbose)
 
-    startTime = datetime.datetime.now()
-    notification = self.listen_for_notification(uri)
-    duration = (datetime.datetime.now() - startTime).total_seconds()
+    startTime = time.perf_counter()
+    notification = self.listen_for_notification(uri, self.documentCounter)
+    duration = time.perf_counter() - startTime
     stdoutOutput, stderrOutput = self.print_output()
 
     if verbose:
-      print("Received notification after {:.1f}s: {}".format(duration, notification))
+      self.log("Received notification after {:.1f}s: {}".format(duration, notification))
     else:
-      print("Obtained {} rule matches after {:.1f}s.".format(
+      self.log("Obtained {} rule matches after {:.1f}s.".format(
           len(notification["params"]["diagnostics"]), duration))
 
     if failOnStderrOutput and (len(stderrOutput) > 0):
@@ -163,19 +301,174 @@ class LSPClient(object):
 
 
 
+def isLikelyBinary(tex: str) -> bool:
+  sample = tex[:binarySniffingSampleSize]
+  if binaryCharacterRegex.search(sample) is not None: return True
+  numberOfNonAsciiCharacters = len(sample.translate(asciiDeletionTable))
+  return numberOfNonAsciiCharacters > maxNonAsciiRatio * len(sample)
+
+
+
 def processArxivTex(lspClient: LSPClient, tex: str, texPath: str, arxivId: str,
       saveTex: Optional[str]) -> None:
+  # LTeX takes very long for these files, and they wouldn't yield meaningful results anyway
+  if isLikelyBinary(tex):
+    lspClient.log("Skipping LaTeX file {} as it seems to be binary.".format(texPath))
+    return
+
   if saveTex is not None:
     saveTexPath = os.path.join(saveTex, (
         "{}.tex".format(arxivId) if os.path.basename(texPath) == arxivId else
         "{}_{}".format(arxivId, os.path.basename(texPath))))
-    print("Saving LaTeX file as: {}".format(saveTexPath))
+    lspClient.log("Saving LaTeX file as: {}".format(saveTexPath))
     with open(saveTexPath, "w") as f: f.write(tex)
 
   lspClient.validate_document(tex, path=texPath)
 
 
 
+def generateArxivId() -> str:
+  year = 18
+  month = random.randrange(1, 13)
+  number = random.randrange(5000)
+  return "{:02}{:02}.{:05}".format(year, month, number)
+
+
+
+class RateLimiter(object):
+  def __init__(self, minimumInterval: float) -> None:
+    self.minimumInterval = minimumInterval
+    self.lock = threading.Lock()
+    self.lastEndTime: Optional[float] = None
+
+  def __enter__(self) -> None:
+    self.lock.acquire()
+
+    if self.lastEndTime is not None:
+      remainingTime = self.lastEndTime + self.minimumInterval - time.monotonic()
+      if remainingTime > 0: time.sleep(remainingTime)
+
+  def __exit__(self, *args: Any) -> None:
+    self.lastEndTime = time.monotonic()
+    self.lock.release()
+
+
+
+# be polite to arxiv.org and wait between downloads (checking the papers doesn't have to wait)
+arxivRateLimiter = RateLimiter(5)
+
+
+
+def downloadArxivPaper(arxivId: str) -> Tuple["tempfile.TemporaryDirectory[str]", str]:
+  tempDirectory = tempfile.TemporaryDirectory()
+  tarPath = os.path.join(tempDirectory.name, arxivId)
+
+  with arxivRateLimiter, \
+        urllib.request.urlopen("https://arxiv.org/e-print/{}".format(arxivId)) as response, \
+        open(tarPath, "wb") as f:
+    source: IO[bytes] = (gzip.GzipFile(fileobj=response)
+        if response.info().get("Content-Encoding") == "x-gzip" else response)
+    shutil.copyfileobj(source, f, 65536)
+
+  return tempDirectory, tarPath
+
+
+
+def findTexFiles(dirPath: str) -> Iterator["os.DirEntry[str]"]:
+  with os.scandir(dirPath) as entries: sortedEntries = sorted(entries, key=lambda x: x.name)
+  subdirPaths = []
+
+  for entry in sortedEntries:
+    if entry.is_dir(follow_symlinks=False):
+      subdirPaths.append(entry.path)
+    elif entry.name.endswith(".tex") and entry.is_file():
+      yield entry
+
+  for subdirPath in subdirPaths: yield from findTexFiles(subdirPath)
+
+
+
+def readTexFile(lspClient: LSPClient, texPath: str, size: int, maxTexBytes: int,
+      encoding: Optional[str] = None) -> Optional[str]:
+  if size > maxTexBytes:
+    lspClient.log("Skipping LaTeX file {} due to its size of {} bytes.".format(texPath, size))
+    return None
+
+  try:
+    with open(texPath, "r", encoding=encoding) as texFile: return texFile.read()
+  except UnicodeDecodeError:
+    lspClient.log("Skipping LaTeX file {} due to Unicode decode error.".format(texPath))
+    return None
+
+
+
+def processArxivPaper(lspClient: LSPClient, arxivId: str, tempDir: str, tarPath: str,
+      saveTex: Optional[str], maxTexBytes: int) -> None:
+  if tarfile.is_tarfile(tarPath):
+    with tarfile.open(tarPath) as tarFile:
+      if any((".." in x) or x.startswith("/") for x in tarFile.getnames()):
+        lspClient.log(("Skipping arXiv paper {} due to suspicious path names in "
+            "tar archive.").format(arxivId))
+        return
+
+      # only LaTeX files are checked, so don't extract figures and other files; use the "data"
+      # extraction filter as an additional safeguard if this Python version supports it
+      extractKwargs = ({"filter" : "data"} if hasattr(tarfile, "data_filter") else {})
+
+      try:
+        for member in tarFile:
+          if member.isreg() and member.name.endswith(".tex"):
+            tarFile.extract(member, tempDir, **extractKwargs)
+      except (tarfile.TarError, OSError) as e:
+        lspClient.log(("Skipping arXiv paper {} due to error while extracting tar archive: "
+            "{}").format(arxivId, e))
+        return
+
+      for entry in findTexFiles(tempDir):
+        tex = readTexFile(lspClient, entry.path, entry.stat().st_size, maxTexBytes)
+        if tex is not None: processArxivTex(lspClient, tex, entry.path, arxivId, saveTex)
+  else:
+    # single-file submissions are decoded as UTF-8 regardless of the locale
+    tex = readTexFile(lspClient, tarPath, os.path.getsize(tarPath), maxTexBytes, encoding="utf-8")
+    if tex is not None: processArxivTex(lspClient, tex, tarPath, arxivId, saveTex)
+
+
+
+def startLanguageServer(ltexArgs: List[str], port: int, name: Optional[str]) -> LSPClient:
+  logPrefix = getLogPrefix(name)
+  host = "localhost"
+  addressInfo = socket.getaddrinfo(host, port)[0]
+  sock = socket.socket()
+  sock.bind(addressInfo[4])
+  port = sock.getsockname()[1]
+  print("{}Using port {}.".format(logPrefix, port))
+
+  ltexStdout = tempfile.TemporaryFile("w+b")
+  ltexStderr = tempfile.TemporaryFile("w+b")
+  print("{}Starting LanguageTool language server...".format(logPrefix))
+  subprocess.Popen(ltexArgs + [str(port)], stdout=ltexStdout, stderr=ltexStderr)
+
+  sock.listen()
+  time.sleep(1)
+  conn, addr = sock.accept()
+
+  # LanguageToolLanguageServerLauncher only accepts a TCP port, so Unix domain sockets can't be
+  # used; disable Nagle's algorithm instead, as LSP consists of many small messages
+  conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+  lspClient = LSPClient(conn, ltexStdout, ltexStderr, name)
+
+  lspClient.send_encoded_request(LSPClient.initializeTemplate, os.getpid(),
+      failOnStderrOutput=False)
+
+  #lspClient.send_notification("workspace/didChangeConfiguration", {
+  #      "settings" : {"ltex" : {"enabled" : True, "language" : "en-US"}},
+  #    })
+
+  return lspClient
+
+
+
 def main() -> None:
   parser = argparse.ArgumentParser(description=
       "Test LTeX VS Code extension on randomly chosen arXiv papers")
@@ -183,122 +476,118 @@ def main() -> None:
       "Number of arXiv papers to check")
   parser.add_argument("--port", type=int, default=0, help=
       "Port to use for the communication with the language server. "
-      "If omitted, use an arbitrary open port.")
+      "If omitted, use an arbitrary open port. If multiple language servers are started, "
+      "the i-th language server (counted from 0) uses the specified port plus i.")
   parser.add_argument("--save-tex", type=str, help=
       "Save checked LaTeX files in the specified directory")
   parser.add_argument("--seed", type=int, help=
       "Use a specific seed to generate arXiv IDs. If omitted, use a random seed.")
+  parser.add_argument("--max-tex-bytes", type=int, default=2000000, help=
+      "Skip LaTeX files that are larger than the specified number of bytes")
+  parser.add_argument("--parallelism", type=int, default=1, help=
+      "Number of language servers to start for checking multiple arXiv papers in parallel")
   args = parser.parse_args()
 
   extensionsPath = os.path.join(pathlib.Path.home(), ".vscode", "extensions")
-  ltexMainPaths = [x for x in os.listdir(extensionsPath)
-      if x.startswith("valentjn.vscode-ltex-") and (x.count("-") == 2)]
-  ltexLanguagePaths = [x for x in os.listdir(extensionsPath)
-      if x.startswith("valentjn.vscode-ltex-en-")]
+  ltexMainPaths: List[Tuple[Tuple[int, ...], str]] = []
+  ltexLanguagePaths: List[Tuple[Tuple[int, ...], str]] = []
+
+  with os.scandir(extensionsPath) as entries:
+    for entry in entries:
+      if entry.name.startswith("valentjn.vscode-ltex-en-"):
+        ltexPaths = ltexLanguagePaths
+      elif entry.name.startswith("valentjn.vscode-ltex-") and (entry.name.count("-") == 2):
+        ltexPaths = ltexMainPaths
+      else:
+        continue
 
-  versionSortKey = (lambda x: [int(y) for y in x.split("-")[-1].split(".")])
-  ltexMainPaths.sort(key=versionSortKey)
-  ltexLanguagePaths.sort(key=versionSortKey)
+      version = tuple(int(x) for x in entry.name.split("-")[-1].split("."))
+      ltexPaths.append((version, entry.name))
 
   if len(ltexMainPaths) == 0:
     raise RuntimeError("No LTeX main extension found.")
   if len(ltexLanguagePaths) == 0:
     raise RuntimeError("No LTeX English language extension found.")
 
-  ltexMainPath, ltexLanguagePath = ltexMainPaths[-1], ltexLanguagePaths[-1]
+  ltexMainPath, ltexLanguagePath = max(ltexMainPaths)[1], max(ltexLanguagePaths)[1]
   print("Using LTeX extension from: {}".format(
         os.path.join(extensionsPath, ltexMainPath)))
   print("Using LTeX English language extension from: {}".format(
         os.path.join(extensionsPath, ltexLanguagePath)))
 
-  host, port = "localhost", args.port
-  addressInfo = socket.getaddrinfo(host, port)[0]
-  sock = socket.socket()
-  sock.bind(addressInfo[4])
-  port = sock.getsockname()[1]
-  print("Using port {}.".format(port))
-
-  ltexStdout = tempfile.TemporaryFile("w+b")
-  ltexStderr = tempfile.TemporaryFile("w+b")
   ltexArgs = ["java", "-classpath", os.pathsep.join([
         os.path.join(extensionsPath, ltexMainPath, "lib", "languagetool-languageserver",
           "build", "install", "languagetool-languageserver", "lib", "ltex-ls-languagetool-patch.jar"),
         os.path.join(extensionsPath, ltexMainPath, "lib", "languagetool-languageserver",
           "build", "install", "languagetool-languageserver", "lib", "*"),
         os.path.join(extensionsPath, ltexLanguagePath,  "lib", "*"),
-      ]), "LanguageToolLanguageServerLauncher", str(port)]
-  print("Starting LanguageTool language server...")
-  process = subprocess.Popen(ltexArgs, stdout=ltexStdout, stderr=ltexStderr)
-
-  sock.listen()
-  time.sleep(1)
-  conn, addr = sock.accept()
+      ]), "LanguageToolLanguageServerLauncher"]
 
-  lspClient = LSPClient(conn, ltexStdout, ltexStderr)
-
-  lspClient.send_request("initialize", {
-        "processId" : os.getpid(), "rootUri" : None, "capabilities" : {},
-      }, failOnStderrOutput=False)
-
-  #lspClient.send_notification("workspace/didChangeConfiguration", {
-  #      "settings" : {"ltex" : {"enabled" : True, "language" : "en-US"}},
-  #    })
+  parallelism = max(min(args.parallelism, args.batch_size), 1)
+  ports = [(args.port + i if args.port != 0 else 0) for i in range(parallelism)]
+  names = [(str(i + 1) if parallelism > 1 else None) for i in range(parallelism)]
 
   seed = args.seed
   if seed is None: seed = random.randrange(1000000)
   print("Using seed {}.".format(seed))
   random.seed(seed)
 
-  for i in range(args.batch_size):
-    year = 18
-    month = random.randrange(1, 13)
-    number = random.randrange(5000)
-    arxivId = "{:02}{:02}.{:05}".format(year, month, number)
-    print("")
-    print("Processing arXiv paper {}...".format(arxivId))
+  arxivIds = [generateArxivId() for i in range(args.batch_size)]
 
-    with tempfile.TemporaryDirectory() as tempDir:
-      response = urllib.request.urlopen("https://arxiv.org/e-print/{}".format(arxivId))
-      tar = response.read()
+  # each language server checks one paper at a time; free language servers wait in the pool
+  lspClientPool: "queue.Queue[LSPClient]" = queue.Queue()
 
-      if response.info().get("Content-Encoding") == "x-gzip": tar = gzip.decompress(tar)
+  def checkArxivPaper(lspClient: LSPClient, arxivId: str,
+        tempDirectory: "tempfile.TemporaryDirectory[str]", tarPath: str) -> None:
+    lspClient.log()
+    lspClient.log("Processing arXiv paper {}...".format(arxivId))
 
-      tarPath = os.path.join(tempDir, arxivId)
-      with open(tarPath, "wb") as f: f.write(tar)
+    with tempDirectory as tempDir:
+      processArxivPaper(lspClient, arxivId, tempDir, tarPath, args.save_tex,
+          args.max_tex_bytes)
 
-      if tarfile.is_tarfile(tarPath):
-        with tarfile.open(tarPath) as tarFile:
-          if any((".." in x) or x.startswith("/") for x in tarFile.getnames()):
-            print(("Skipping arXiv paper {} due to suspicious path names in "
-                "tar archive.").format(arxivId))
-            continue
+  with concurrent.futures.ThreadPoolExecutor(max_workers=prefetchCount) as downloadExecutor, \
+        concurrent.futures.ThreadPoolExecutor(max_workers=parallelism) as checkExecutor:
+    for lspClient in checkExecutor.map(startLanguageServer,
+          parallelism * [ltexArgs], ports, names):
+      lspClientPool.put(lspClient)
 
-          tarFile.extractall(tempDir)
+    # download the next papers while the current papers are being checked
+    downloadFutures = collections.deque(downloadExecutor.submit(downloadArxivPaper, x)
+        for x in arxivIds[:prefetchCount])
+    checkFutures: List["concurrent.futures.Future[None]"] = []
 
-          for root, dirs, files in os.walk(tempDir):
-            for file_ in sorted(files):
-              if file_.endswith(".tex"):
-                texPath = os.path.join(root, file_)
+    for i, arxivId in enumerate(arxivIds):
+      # wait for a free language server before taking the next download, so that only
+      # prefetchCount papers are downloaded in advance
+      lspClient = lspClientPool.get()
 
-                try:
-                  with open(texPath, "r") as texFile: tex = texFile.read()
-                except UnicodeDecodeError:
-                  print("Skipping LaTeX file {} due to Unicode decode error.".format(texPath))
-                  continue
+      # re-raise errors of finished checks and only keep the checks that are still running
+      runningCheckFutures = []
 
-                processArxivTex(lspClient, tex, texPath, arxivId, args.save_tex)
-      else:
-        texPath = tarPath
+      for checkFuture in checkFutures:
+        if checkFuture.done():
+          checkFuture.result()
+        else:
+          runningCheckFutures.append(checkFuture)
 
-        try:
-          tex = tar.decode()
-        except UnicodeDecodeError:
-          print("Skipping LaTeX file {} due to Unicode decode error.".format(texPath))
-          continue
+      checkFutures = runningCheckFutures
+
+      tempDirectory, tarPath = downloadFutures.popleft().result()
+
+      if i + prefetchCount < len(arxivIds):
+        downloadFutures.append(downloadExecutor.submit(downloadArxivPaper,
+            arxivIds[i + prefetchCount]))
 
-        processArxivTex(lspClient, tex, texPath, arxivId, args.save_tex)
+      checkFuture = checkExecutor.submit(checkArxivPaper, lspClient, arxivId, tempDirectory,
+          tarPath)
+      # return the language server to the pool only after the future is done, so that a
+      # failed check is noticed before the language server is reused
+      checkFuture.add_done_callback(
+          lambda future, lspClient=lspClient: lspClientPool.put(lspClient))
+      checkFutures.append(checkFuture)
 
-    time.sleep(5)
+    for checkFuture in checkFutures: checkFuture.result()
 
 
 